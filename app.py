@@ -9,6 +9,7 @@ Example:
 
 # import all the relevant libraries/functionality
 import sys
+import time
 # import fire and questionary for user interaction
 import fire
 import questionary
@@ -31,6 +32,12 @@ from qualifier.filters.credit_score import filter_credit_score
 from qualifier.filters.debt_to_income import filter_debt_to_income
 from qualifier.filters.loan_to_value import filter_loan_to_value
 
+# import the batch kernel used to keep a parsed rate sheet in session mode
+from qualifier.filters.batch_kernel import rate_sheet_arrays, qualify_applicants
+
+# import profiling helpers
+from qualifier.utils.profiler import Profiler, phase, waiting_for_input
+
 # Global to control debug output
 debug = False
 # Global to control the maximum number of time to wait for a valid input
@@ -64,6 +71,7 @@ def check_csvpath_name(csvpath, try_attempt):
         return False
 
 
+@phase("load_bank_data")
 def load_bank_data(try_attempt = 0):
     """Ask for the file path to the latest banking data and load the CSV file.
 
@@ -77,7 +85,8 @@ def load_bank_data(try_attempt = 0):
     '''
 
     # Ask for the .csv file from where to load the bank data
-    csvpath = questionary.text("Enter a file path to a rate-sheet (.csv):").ask()
+    with waiting_for_input():
+        csvpath = questionary.text("Enter a file path to a rate-sheet (.csv):").ask()
     # check if the csv file path name is valid
     if check_csvpath_name(csvpath, try_attempt):
         # the path name is valid, so check if the path exists. 
@@ -104,7 +113,8 @@ def get_user_applicant_info(query_text, info_type):
     for input_try in range(max_input_tries):
         try:
             # Try to obtain the input
-            info = questionary.text(f"What's your {query_text}?").ask()
+            with waiting_for_input():
+                info = questionary.text(f"What's your {query_text}?").ask()
             # bail out if ctrl+c was entered. Questionary handles ctrl+c by returning None
             if info == None:
                 sys.exit("Ctrl+C detected. Exiting the program")
@@ -122,6 +132,7 @@ def get_user_applicant_info(query_text, info_type):
     # bail out of the application if no valid input is received in max specified attempts.
     sys.exit(f"Exiting because no valid input received in {max_input_tries} attempts")
 
+@phase("applicant input")
 def get_applicant_info():
     """Prompt dialog to get the applicant's financial information.
 
@@ -159,7 +170,8 @@ def get_applicant_info():
     return credit_score, debt, income, loan_amount, home_value
 
 
-def find_qualifying_loans(bank_data, credit_score, debt, income, loan, home_value):
+@phase("find_qualifying_loans")
+def find_qualifying_loans(bank_data, credit_score, debt, income, loan, home_value, bank_arrays = None):
     """Determine which loans the user qualifies for.
 
     Loan qualification criteria is based on:
@@ -175,6 +187,8 @@ def find_qualifying_loans(bank_data, credit_score, debt, income, loan, home_valu
         income (float): The applicant's total monthly income.
         loan (float): The total loan amount applied for.
         home_value (float): The estimated home value.
+        bank_arrays (tuple): Optional rate_sheet_arrays(bank_data), parsed once and reused.
+            When given, all four criteria are checked at once by the batch kernel.
 
     Returns:
         A list of the banks willing to underwrite the loan.
@@ -189,25 +203,39 @@ def find_qualifying_loans(bank_data, credit_score, debt, income, loan, home_valu
     loan_to_value_ratio = calculate_loan_to_value_ratio(loan, home_value)
     print(f"The loan to value ratio is {loan_to_value_ratio:.02f}.")
 
+    # Use the already parsed rate sheet when we have one instead of parsing each row in the filters.
+    # In debug mode keep running the filters one by one so that the count after each filter is shown.
+    if bank_arrays is not None and debug == False:
+        with phase("qualify_applicants"):
+            qualified = qualify_applicants(bank_arrays, [(credit_score, debt, income, loan, home_value)])[0]
+        bank_data_filtered = [bank for bank, is_qualified in zip(bank_data, qualified) if is_qualified]
+        if len(bank_data_filtered) > 0:
+            print(f"Found {len(bank_data_filtered)} qualifying loans")
+        return bank_data_filtered
+
     # Run qualification filters
 
     # filter loans based on max loan size that the banks are willing to allow
-    bank_data_filtered = filter_max_loan_size(loan, bank_data)
+    with phase("filter_max_loan_size"):
+        bank_data_filtered = filter_max_loan_size(loan, bank_data)
     if debug == True:
         print(f"Found {len(bank_data_filtered)} qualifying loans based on max loan size filter")
 
     # filter loans based on the minimum credit score requirements of the bank
-    bank_data_filtered = filter_credit_score(credit_score, bank_data_filtered)
+    with phase("filter_credit_score"):
+        bank_data_filtered = filter_credit_score(credit_score, bank_data_filtered)
     if debug == True:
         print(f"Found {len(bank_data_filtered)} qualifying loans based on credit score filter")
 
     # filter loans based on debt to income ratio
-    bank_data_filtered = filter_debt_to_income(monthly_debt_ratio, bank_data_filtered)
+    with phase("filter_debt_to_income"):
+        bank_data_filtered = filter_debt_to_income(monthly_debt_ratio, bank_data_filtered)
     if debug == True:
         print(f"Found {len(bank_data_filtered)} qualifying loans based on debt to income filter")
 
     # filter loans based on loan to home value ratio
-    bank_data_filtered = filter_loan_to_value(loan_to_value_ratio, bank_data_filtered)
+    with phase("filter_loan_to_value"):
+        bank_data_filtered = filter_loan_to_value(loan_to_value_ratio, bank_data_filtered)
     if debug == True:
         print(f"Found {len(bank_data_filtered)} qualifying loans based on loan to value filter")
 
@@ -218,6 +246,7 @@ def find_qualifying_loans(bank_data, credit_score, debt, income, loan, home_valu
     return bank_data_filtered
 
 
+@phase("save_qualifying_loans")
 def save_qualifying_loans(qualifying_loans, header, prompt = True, try_attempt = 0):
     """Saves the qualifying loans to a CSV file.
 
@@ -232,14 +261,16 @@ def save_qualifying_loans(qualifying_loans, header, prompt = True, try_attempt =
     # This is used when an invalid file name is received. 
     # We retry to obtain a valid file name without prompting the user if they want to save to a csv file
     if prompt == True:
-        save_the_csv = questionary.confirm("Do you want to save the loans output to a csv file?").ask()
+        with waiting_for_input():
+            save_the_csv = questionary.confirm("Do you want to save the loans output to a csv file?").ask()
     else:
         save_the_csv = True
 
     # if the user wants to save the qualifying loans to a csv file
     if save_the_csv == True:
         # obtain the csv file name
-        csvpath = questionary.text("Please provide the csv path (ending in .csv) where you want to save the qualifying loans:").ask()
+        with waiting_for_input():
+            csvpath = questionary.text("Please provide the csv path (ending in .csv) where you want to save the qualifying loans:").ask()
         # check if the csv file name is valid
         if check_csvpath_name(csvpath, try_attempt):
             if debug == True:
@@ -257,22 +288,17 @@ def save_qualifying_loans(qualifying_loans, header, prompt = True, try_attempt =
 
 
 
-def run(verbose = False, help = False, v = False, h = False):
-    """The main function for running the script."""
+def run_qualifier(session = False):
+    """Qualifies one applicant, or many applicants when session is set.
 
-    # Print the application's command line options
-    if help == True or h == True:
-        print("python app.py --verbose : for debug mode")
-        print("python app.py --v       : for debug mode")
-        print("python app.py --help    : for help options")
-        print("python app.py --h       : for help options")
-        sys.exit()
+    Args:
+        session: loop over applicants against one loaded rate sheet
+    """
 
-    # Set the debugging mode based on the verbose or v option
-    if verbose == True or v == True:
-        global debug
-        debug = True
-        print(f"Verbose mode: setting debug to {debug}")
+    # In session mode keep the rate sheet loaded and loop over the applicants
+    if session == True:
+        run_session()
+        return
 
     # Load the latest Bank data
     header, bank_data = load_bank_data()
@@ -294,5 +320,130 @@ def run(verbose = False, help = False, v = False, h = False):
     save_qualifying_loans(qualifying_loans, header)
 
 
+def load_session_rate_sheet():
+    """Loads the rate sheet and parses it once for the session.
+
+    Returns:
+        The header, the bank data and its rate_sheet_arrays.
+    Raises:
+        ValueError if a row of the rate sheet does not have as many columns as the header.
+    """
+
+    header, bank_data = load_bank_data()
+    # every row needs all the columns of the header, otherwise parsing it fails further down
+    for row_number, bank in enumerate(bank_data, start = 1):
+        if len(bank) != len(header):
+            raise ValueError(f"row {row_number} of the rate sheet has {len(bank)} columns instead of {len(header)}")
+    bank_arrays = rate_sheet_arrays(bank_data)
+    # run the kernel once on no applicants so that numba compiles it now rather than for the first applicant
+    qualify_applicants(bank_arrays, [])
+    return header, bank_data, bank_arrays
+
+
+def run_session():
+    """Qualifies many applicants, one after another, against one loaded rate sheet.
+
+    The rate sheet is loaded once and kept in memory until the user asks to reload it.
+    Ctrl+C, too many invalid entries or an error while processing a request only abandon
+    the current applicant or reload instead of exiting the application.
+    """
+
+    # Load the latest Bank data once for the whole session and keep it parsed
+    header, bank_data, bank_arrays = load_session_rate_sheet()
+    applicant_count = 0
+
+    while True:
+        with waiting_for_input():
+            action = questionary.select(
+                "What would you like to do?",
+                choices=["Qualify an applicant", "Reload the rate sheet", "Exit"],
+            ).ask()
+
+        # Ctrl+C returns None. Treat it like Exit
+        if action == None or action == "Exit":
+            print(f"Session ended after {applicant_count} applicants")
+            return
+
+        # The input helpers call sys.exit on Ctrl+C or after max_input_tries invalid inputs,
+        # and bad data (income of 0, empty or unreadable csv files) raises errors.
+        # Catch them so that only the current request is abandoned and the session goes on.
+        try:
+            if action == "Reload the rate sheet":
+                # only replace the current rate sheet once the new one is fully loaded
+                new_header, new_bank_data, new_bank_arrays = load_session_rate_sheet()
+                header, bank_data, bank_arrays = new_header, new_bank_data, new_bank_arrays
+                print(f"Reloaded the rate sheet with {len(bank_data)} loans")
+                continue
+
+            # Get the applicant's information
+            credit_score, debt, income, loan_amount, home_value = get_applicant_info()
+
+            # Find qualifying loans and time it, leaving out the time spent at the prompts
+            start_time = time.perf_counter()
+            qualifying_loans = find_qualifying_loans(
+                bank_data, credit_score, debt, income, loan_amount, home_value, bank_arrays
+            )
+            response_time = time.perf_counter() - start_time
+            applicant_count += 1
+            print(f"Applicant {applicant_count} processed in {response_time * 1000:.03f} ms")
+
+            # Inform the user if they did not qualify, otherwise offer to save the loans
+            if len(qualifying_loans) == 0:
+                print("Sorry! you don't qualify for any loans")
+            else:
+                save_qualifying_loans(qualifying_loans, header)
+        except SystemExit:
+            # the helpers' exit messages do not apply, the session carries on
+            if action == "Reload the rate sheet":
+                print("Rate sheet reload cancelled")
+            else:
+                print("Applicant entry cancelled")
+            print_session_request_abandoned(action)
+        except (ZeroDivisionError, ValueError, OSError, StopIteration) as error:
+            print(f"Error: {type(error).__name__} {error}".rstrip())
+            print_session_request_abandoned(action)
+
+
+def print_session_request_abandoned(action):
+    """Informs the user of what happens after a session request failed.
+
+    Input:
+        action - the session menu choice that failed
+    """
+    if action == "Reload the rate sheet":
+        print("Keeping the previously loaded rate sheet")
+    else:
+        print("Skipping this applicant")
+
+
+def run(verbose = False, help = False, v = False, h = False, session = False, s = False, profile = False):
+    """The main function for running the script."""
+
+    # Print the application's command line options
+    if help == True or h == True:
+        print("python app.py --verbose : for debug mode")
+        print("python app.py --v       : for debug mode")
+        print("python app.py --session : to qualify many applicants against one rate sheet")
+        print("python app.py --s       : to qualify many applicants against one rate sheet")
+        print("python app.py --profile : to profile the run (--profile=<path>.prof to choose the output file)")
+        print("python app.py --help    : for help options")
+        print("python app.py --h       : for help options")
+        sys.exit()
+
+    # Set the debugging mode based on the verbose or v option
+    if verbose == True or v == True:
+        global debug
+        debug = True
+        print(f"Verbose mode: setting debug to {debug}")
+
+    # Profile the run if asked to. The profile is saved even if the application exits early
+    if profile != False:
+        profile_path = profile if isinstance(profile, str) else "profile/loan_qualifier.prof"
+        with Profiler(profile_path):
+            run_qualifier(session == True or s == True)
+    else:
+        run_qualifier(session == True or s == True)
+
+
 if __name__ == "__main__":
     fire.Fire(run)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Batch Qualification Kernel.
+
+This script evaluates all four loan qualification criteria (max loan size,
+credit score, debt to income and loan to value) for a batch of applicants
+against the whole bank list in one pass. When numba is installed the kernel is
+JIT compiled and runs in parallel across the applicants. Otherwise the same
+kernel runs as plain Python over lists.
+
+"""
+
+# numba (and the numpy it depends on) are optional.
+# Without them the kernel below runs as regular python code.
+try:
+    import numpy as np
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    np = None
+    prange = range
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """Stand in for numba.njit that returns the function unchanged."""
+        def decorator(function):
+            return function
+        return decorator
+
+# import calculators
+from qualifier.utils.calculators import (
+    calculate_monthly_debt_ratio,
+    calculate_loan_to_value_ratio,
+)
+
+
+@njit(parallel=True, cache=True)
+def _qualify_kernel(credit_scores, loan_amounts, monthly_debt_ratios, loan_to_value_ratios,
+                    max_loan_sizes, min_credit_scores, max_debt_ratios, max_loan_to_value_ratios,
+                    qualified):
+    """Marks qualified[i][j] when applicant i meets all the requirements of bank j.
+
+    The comparisons are the same as in the max loan size, credit score,
+    debt to income and loan to value filters.
+    """
+
+    for i in prange(len(credit_scores)):
+        row = qualified[i]
+        for j in range(len(max_loan_sizes)):
+            row[j] = (
+                loan_amounts[i] <= max_loan_sizes[j]
+                and credit_scores[i] >= min_credit_scores[j]
+                and monthly_debt_ratios[i] <= max_debt_ratios[j]
+                and loan_to_value_ratios[i] <= max_loan_to_value_ratios[j]
+            )
+
+
+def _to_array(values, dtype):
+    """Returns the values as a numpy array when numba is available, otherwise as a list."""
+    if NUMBA_AVAILABLE:
+        return np.array(values, dtype=dtype)
+    return list(values)
+
+
+def rate_sheet_arrays(bank_list):
+    """Converts the bank list into one array per qualification requirement.
+
+    The arrays can be built once per rate sheet and reused for every batch.
+
+    Args:
+        bank_list (list of lists): The available bank loans.
+
+    Returns:
+        max loan sizes, min credit scores, max debt to income ratios and max loan to value ratios.
+    """
+
+    max_loan_sizes = _to_array([int(bank[1]) for bank in bank_list], "int64")
+    min_credit_scores = _to_array([int(bank[4]) for bank in bank_list], "int64")
+    max_debt_ratios = _to_array([float(bank[3]) for bank in bank_list], "float64")
+    max_loan_to_value_ratios = _to_array([float(bank[2]) for bank in bank_list], "float64")
+    return max_loan_sizes, min_credit_scores, max_debt_ratios, max_loan_to_value_ratios
+
+
+def applicant_arrays(applicants):
+    """Converts the applicants into one array per qualification criteria.
+
+    With numba the ratios are calculated on whole numpy columns, truncating to
+    integers first like calculate_monthly_debt_ratio and calculate_loan_to_value_ratio
+    do. Otherwise the calculators themselves are used.
+
+    Args:
+        applicants (list of tuples): (credit_score, debt, income, loan, home_value) per applicant.
+            With numba an (n, 5) numpy array in the same column order is also accepted.
+
+    Returns:
+        credit scores, loan amounts, monthly debt ratios and loan to value ratios.
+    """
+
+    if NUMBA_AVAILABLE:
+        # an (n, 5) float64 array is used as is, a list of tuples is converted once
+        columns = np.asarray(applicants, dtype=np.float64).reshape(-1, 5)
+        credit_scores, debts, incomes, loan_amounts, home_values = columns.T
+        incomes = np.trunc(incomes)
+        home_values = np.trunc(home_values)
+        # the calculators raise on a zero denominator where numpy would return inf
+        if (incomes == 0).any() or (home_values == 0).any():
+            raise ZeroDivisionError("division by zero")
+        # dividing the truncated (exact) floats rounds the same way as the calculators' int / int
+        monthly_debt_ratios = np.trunc(debts) / incomes
+        loan_to_value_ratios = np.trunc(loan_amounts) / home_values
+        return (
+            np.ascontiguousarray(credit_scores),
+            np.ascontiguousarray(loan_amounts),
+            monthly_debt_ratios,
+            loan_to_value_ratios,
+        )
+
+    credit_scores = _to_array([applicant[0] for applicant in applicants], "int64")
+    loan_amounts = _to_array([applicant[3] for applicant in applicants], "float64")
+    monthly_debt_ratios = _to_array(
+        [calculate_monthly_debt_ratio(debt, income) for _, debt, income, _, _ in applicants], "float64"
+    )
+    loan_to_value_ratios = _to_array(
+        [calculate_loan_to_value_ratio(loan, home_value) for _, _, _, loan, home_value in applicants], "float64"
+    )
+    return credit_scores, loan_amounts, monthly_debt_ratios, loan_to_value_ratios
+
+
+def allocate_qualified_buffer(applicant_count, bank_count):
+    """Allocates the applicants x banks output buffer used by qualify_applicants.
+
+    Args:
+        applicant_count (int): The number of applicants in the batch.
+        bank_count (int): The number of bank loans.
+
+    Returns:
+        A boolean numpy array when numba is available, otherwise a list of bytearrays.
+    """
+
+    if NUMBA_AVAILABLE:
+        return np.zeros((applicant_count, bank_count), dtype=np.bool_)
+    return [bytearray(bank_count) for _ in range(applicant_count)]
+
+
+def check_qualified_buffer(qualified, applicant_count, bank_count):
+    """Checks that a buffer has the layout allocate_qualified_buffer would give it.
+
+    Args:
+        qualified: The buffer to check.
+        applicant_count (int): The number of applicants in the batch.
+        bank_count (int): The number of bank loans.
+
+    Raises:
+        ValueError if the buffer does not hold applicant_count x bank_count results.
+    """
+
+    if NUMBA_AVAILABLE:
+        if not isinstance(qualified, np.ndarray) or qualified.dtype != np.bool_:
+            raise ValueError("The qualified buffer must be a numpy array of np.bool_")
+        if qualified.shape != (applicant_count, bank_count):
+            raise ValueError(
+                f"The qualified buffer has shape {qualified.shape}, expected {(applicant_count, bank_count)}"
+            )
+    elif len(qualified) != applicant_count or any(len(row) != bank_count for row in qualified):
+        raise ValueError(f"The qualified buffer must have {applicant_count} rows of {bank_count} entries")
+
+
+def qualify_applicants(bank_arrays, applicants, qualified = None):
+    """Evaluates every applicant of the batch against every bank loan.
+
+    Args:
+        bank_arrays (tuple): The arrays returned by rate_sheet_arrays.
+        applicants (list of tuples): (credit_score, debt, income, loan, home_value) per applicant.
+        qualified: Optional buffer from allocate_qualified_buffer to write the results into.
+
+    Returns:
+        The buffer where entry [i][j] is true when applicant i qualifies for bank loan j.
+    """
+
+    # allocate the output buffer unless the caller provided one to reuse
+    if qualified is None:
+        qualified = allocate_qualified_buffer(len(applicants), len(bank_arrays[0]))
+    else:
+        # the compiled kernel does not check bounds, so a wrong buffer would corrupt memory
+        check_qualified_buffer(qualified, len(applicants), len(bank_arrays[0]))
+    _qualify_kernel(*applicant_arrays(applicants), *bank_arrays, qualified)
+    return qualified
+
+
+def find_qualifying_loans_batch(bank_list, applicants):
+    """Finds the qualifying loans of every applicant in the batch.
+
+    Args:
+        bank_list (list of lists): The available bank loans.
+        applicants (list of tuples): (credit_score, debt, income, loan, home_value) per applicant.
+
+    Returns:
+        A list with the qualifying bank loans of each applicant, in bank list order.
+    """
+
+    qualified = qualify_applicants(rate_sheet_arrays(bank_list), applicants)
+    return [
+        [bank for bank, is_qualified in zip(bank_list, row) if is_qualified]
+        for row in qualified
+    ]
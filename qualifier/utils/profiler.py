@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Profiling helpers.
+
+This script profiles the application with cProfile and times its phases
+(loading the rate sheet, applicant input, finding and saving the qualifying
+loans). Time spent waiting for the user at an interactive prompt is left out
+of both the cProfile statistics and the phase times, so that only compute
+time is reported.
+
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+from contextlib import contextmanager
+
+# Only functions from app.py and the qualifier package are listed in the hot spots.
+# The profiler's own frames (and the contextlib frames of phase/waiting_for_input) are left out.
+APPLICATION_FUNCTIONS = r"(^|[/\\])(app\.py|qualifier[/\\](?!utils[/\\]profiler\.py))"
+
+# The profiler currently running, if any. phase() and waiting_for_input() do nothing without it.
+active_profiler = None
+
+
+class Profiler:
+    """Collects cProfile statistics and phase times, excluding the time spent at prompts.
+
+    Usage:
+        with Profiler("profile/loan_qualifier.prof"):
+            ...
+    """
+
+    def __init__(self, profile_path = "profile/loan_qualifier.prof", top = 20):
+        """Creates the profiler.
+
+        Args:
+            profile_path: where the pstats dump is written. The text summary is written next to it with a .txt extension.
+            top: the number of hot spots listed in the text summary.
+        """
+        self.profile_path = profile_path
+        self.top = top
+        self.phase_times = {}
+        self._open_phases = set()
+        self._waiting_time = 0.0
+        self._waiting_since = None
+        # cProfile uses our timer so that the clock stops while waiting for the user
+        self.profile = cProfile.Profile(self.compute_time)
+
+    def compute_time(self):
+        """Returns the elapsed time in seconds, not counting the time spent waiting for input."""
+        if self._waiting_since is not None:
+            return self._waiting_since - self._waiting_time
+        return time.perf_counter() - self._waiting_time
+
+    def __enter__(self):
+        global active_profiler
+        active_profiler = self
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_profiler
+        self.profile.disable()
+        active_profiler = None
+        self.report()
+        # do not swallow exceptions, including sys.exit
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the compute time spent in the block to the phase called name.
+
+        Nested or recursive blocks of the same phase are only counted once.
+        """
+        if name in self._open_phases:
+            yield
+            return
+        self._open_phases.add(name)
+        start_time = self.compute_time()
+        try:
+            yield
+        finally:
+            self._open_phases.discard(name)
+            self.phase_times[name] = self.phase_times.get(name, 0.0) + self.compute_time() - start_time
+
+    @contextmanager
+    def waiting_for_input(self):
+        """Stops the clock while the block waits for the user."""
+        self._waiting_since = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._waiting_time += time.perf_counter() - self._waiting_since
+            self._waiting_since = None
+
+    def summary(self):
+        """Builds the text summary with the phase times and the top hot spots.
+
+        Returns:
+            The summary as a string.
+        """
+        stream = io.StringIO()
+        stream.write("Phase times (excluding time waiting for input):\n")
+        for name, seconds in sorted(self.phase_times.items(), key=lambda item: item[1], reverse=True):
+            stream.write(f"  {name:<30} {seconds * 1000:12.03f} ms\n")
+        stream.write(f"Time waiting for input (excluded): {self._waiting_time:.03f} s\n\n")
+
+        # list the application functions with the most time spent in their own code, then by cumulative time
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("tottime").print_stats(APPLICATION_FUNCTIONS, self.top)
+        stats.sort_stats("cumulative").print_stats(APPLICATION_FUNCTIONS, self.top)
+        return stream.getvalue()
+
+    def report(self):
+        """Writes the pstats dump and the text summary, and prints the summary."""
+        # if the dir does not exist, create the dir
+        profile_dir = os.path.dirname(self.profile_path)
+        if profile_dir and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir, exist_ok = True)
+
+        self.profile.dump_stats(self.profile_path)
+        summary = self.summary()
+        summary_path = os.path.splitext(self.profile_path)[0] + ".txt"
+        with open(summary_path, "w") as summary_file:
+            summary_file.write(summary)
+
+        print(summary)
+        print(f"Saved the profile to '{self.profile_path}' and the summary to '{summary_path}'")
+
+
+@contextmanager
+def phase(name):
+    """Times the block as the phase called name when a profiler is running."""
+    if active_profiler is None:
+        yield
+    else:
+        with active_profiler.phase(name):
+            yield
+
+
+@contextmanager
+def waiting_for_input():
+    """Excludes the block from the profile when a profiler is running."""
+    if active_profiler is None:
+        yield
+    else:
+        with active_profiler.waiting_for_input():
+            yield
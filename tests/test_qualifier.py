@@ -1,5 +1,9 @@
-# Import pathlib
+# Import pathlib and time
 from pathlib import Path
+import time
+
+# Import pytest
+import pytest
 
 #Import fileio
 from qualifier.utils import fileio
@@ -7,11 +11,19 @@ from qualifier.utils import fileio
 # Import Calculators
 from qualifier.utils import calculators
 
+# Import Aggregators
+from qualifier.utils import aggregators
+
+# Import Profiler
+from qualifier.utils import profiler
+
 # Import Filters
 from qualifier.filters.max_loan_size import filter_max_loan_size
 from qualifier.filters.credit_score import filter_credit_score
 from qualifier.filters.debt_to_income import filter_debt_to_income
 from qualifier.filters.loan_to_value import filter_loan_to_value
+from qualifier.filters import batch_kernel
+from qualifier.filters.batch_kernel import find_qualifying_loans_batch
 
 # The input loan data that we reference to validate the filtering of loans
 loan_data = [
@@ -207,3 +219,330 @@ def test_filters_elaborate():
     qualifying_loans_path = './tests/output_elaborate_validation/qualifying_loans_final.csv'
     loan_index_list = [0, 5, 9, 12, 14, 18]
     save_to_csv_and_validate_bank_loan_data(qualifying_loans_path, header, bank_data_filtered, loan_index_list)
+
+def build_threshold_applicants():
+    """Builds applicants whose credit score, loan size and ratios land on and around the
+        thresholds of the rate sheet so that ties with the bank requirements are exercised
+
+    Returns:
+        A list of (credit_score, debt, income, loan, home_value) tuples
+    """
+    applicants = []
+    for credit_score in [550, 640, 740, 750, 790, 800]:
+        for debt, income in [(1500, 4000), (1400, 4000), (1880, 4000), (2000, 4000)]:
+            for loan, home_value in [(100000, 125000), (210000, 250000), (300000, 352942), (400000, 400000), (600000, 700000)]:
+                applicants.append((credit_score, debt, income, loan, home_value))
+    return applicants
+
+def find_qualifying_loans_with_filters(bank_data, credit_score, debt, income, loan, home_value):
+    """Finds the qualifying loans of one applicant by running all the filters
+
+    Input:
+        bank_data - the bank loan data to filter
+        credit_score, debt, income, loan, home_value - the applicant's information
+    Returns:
+        The qualifying loans
+    """
+    bank_data_filtered = filter_max_loan_size(loan, bank_data)
+    bank_data_filtered = filter_credit_score(credit_score, bank_data_filtered)
+    bank_data_filtered = filter_debt_to_income(calculators.calculate_monthly_debt_ratio(debt, income), bank_data_filtered)
+    bank_data_filtered = filter_loan_to_value(calculators.calculate_loan_to_value_ratio(loan, home_value), bank_data_filtered)
+    return bank_data_filtered
+
+def test_count_qualifying_loans(monkeypatch):
+    """Validate that the aggregate loan counts match the number of loans returned by the filters.
+        Applicants are chosen to land exactly on the bank thresholds to exercise ties.
+    """
+    # load the header and bank loan data from the csv file
+    header, bank_data = fileio.load_csv(Path('./data/daily_rate_sheet.csv'))
+
+    # build applicants from every combination of threshold values found in the rate sheet
+    applicants = build_threshold_applicants()
+
+    # the counts should match the filters applicant by applicant
+    expected_counts = [len(find_qualifying_loans_with_filters(bank_data, *applicant)) for applicant in applicants]
+    assert aggregators.count_qualifying_loans(bank_data, applicants) == expected_counts
+    # the applicant used in test_filters qualifies for 6 loans
+    assert aggregators.count_qualifying_loans(bank_data, [(750, 1500, 4000, 210000, 250000)]) == [6]
+
+    # the rate sheet is small enough to be counted directly.
+    # Force the divide and conquer used for large rate sheets and check it gives the same counts
+    monkeypatch.setattr(aggregators, "DIRECT_COUNT_MAX_LOANS", 0)
+    assert aggregators.count_qualifying_loans(bank_data, applicants) == expected_counts
+    # repeat the rate sheet so that loans with equal thresholds land on both sides of the splits
+    assert aggregators.count_qualifying_loans(bank_data * 3, applicants) == [count * 3 for count in expected_counts]
+
+    # the histogram should hold the number of applicants for each count
+    histogram = aggregators.qualifying_loan_count_histogram(bank_data, applicants)
+    assert len(histogram) == len(bank_data) + 1
+    assert sum(histogram) == len(applicants)
+    for count, applicant_count in enumerate(histogram):
+        assert applicant_count == expected_counts.count(count)
+
+def test_find_qualifying_loans_batch():
+    """Validate that the batch kernel (compiled or pure python) returns exactly the loans
+        returned by the filters, in the same order, for every applicant of the batch
+    """
+    # load the header and bank loan data from the csv file
+    header, bank_data = fileio.load_csv(Path('./data/daily_rate_sheet.csv'))
+
+    # build applicants from every combination of threshold values found in the rate sheet
+    applicants = build_threshold_applicants()
+
+    batch_loans = find_qualifying_loans_batch(bank_data, applicants)
+    assert len(batch_loans) == len(applicants)
+    for applicant, qualifying_loans in zip(applicants, batch_loans):
+        # run the filters for this applicant and compare the actual loans
+        assert qualifying_loans == find_qualifying_loans_with_filters(bank_data, *applicant)
+
+def test_applicant_arrays_match_calculators():
+    """Validate that the applicant ratios (vectorised with numba, calculators without) are identical
+        to the calculators, including the truncation of fractional amounts, and that an income
+        of 0 raises like the calculators do
+    """
+    applicants = build_threshold_applicants() + [(700, 1500.9, 4000.5, 210000.7, 250000.2), (700, 1, 3, 2, 3)]
+    credit_scores, loan_amounts, monthly_debt_ratios, loan_to_value_ratios = batch_kernel.applicant_arrays(applicants)
+    assert list(credit_scores) == [applicant[0] for applicant in applicants]
+    assert list(loan_amounts) == [applicant[3] for applicant in applicants]
+    assert list(monthly_debt_ratios) == [
+        calculators.calculate_monthly_debt_ratio(debt, income) for _, debt, income, _, _ in applicants
+    ]
+    assert list(loan_to_value_ratios) == [
+        calculators.calculate_loan_to_value_ratio(loan, home_value) for _, _, _, loan, home_value in applicants
+    ]
+
+    with pytest.raises(ZeroDivisionError):
+        batch_kernel.applicant_arrays([(750, 1500, 0.5, 210000, 250000)])
+
+def test_qualify_applicants_rejects_wrong_buffer():
+    """Validate that a preallocated buffer of the wrong size is rejected before the kernel
+        writes to it, instead of writing past its end
+    """
+    # load the header and bank loan data from the csv file
+    header, bank_data = fileio.load_csv(Path('./data/daily_rate_sheet.csv'))
+    bank_arrays = batch_kernel.rate_sheet_arrays(bank_data)
+    applicants = build_threshold_applicants()[:5]
+
+    # too few applicants, too few banks and too many banks
+    for applicant_count, bank_count in [(3, len(bank_data)), (5, 10), (5, len(bank_data) + 1)]:
+        with pytest.raises(ValueError):
+            batch_kernel.qualify_applicants(
+                bank_arrays, applicants, batch_kernel.allocate_qualified_buffer(applicant_count, bank_count)
+            )
+
+    # a buffer of the right size is filled in
+    qualified = batch_kernel.allocate_qualified_buffer(5, len(bank_data))
+    assert batch_kernel.qualify_applicants(bank_arrays, applicants, qualified) is qualified
+
+def test_qualify_applicants_rejects_wrong_buffer_type():
+    """Validate that the compiled kernel only accepts np.bool_ buffers. Skipped when numba is not installed.
+    """
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("numba")
+
+    # load the header and bank loan data from the csv file
+    header, bank_data = fileio.load_csv(Path('./data/daily_rate_sheet.csv'))
+    bank_arrays = batch_kernel.rate_sheet_arrays(bank_data)
+    applicants = build_threshold_applicants()[:5]
+
+    for qualified in [np.zeros((5, len(bank_data)), dtype=np.int64), [bytearray(len(bank_data)) for _ in range(5)]]:
+        with pytest.raises(ValueError):
+            batch_kernel.qualify_applicants(bank_arrays, applicants, qualified)
+
+def test_compiled_qualify_kernel():
+    """Validate that the numba compiled kernel writes exactly what the pure python kernel writes
+        into the same kind of preallocated buffer, and that the compiled batch matches the filters.
+        Skipped when numba is not installed.
+    """
+    pytest.importorskip("numba")
+    assert batch_kernel.NUMBA_AVAILABLE == True
+
+    # load the header and bank loan data from the csv file
+    header, bank_data = fileio.load_csv(Path('./data/daily_rate_sheet.csv'))
+    applicants = build_threshold_applicants()
+    bank_arrays = batch_kernel.rate_sheet_arrays(bank_data)
+    applicant_arrays = batch_kernel.applicant_arrays(applicants)
+
+    # run the compiled kernel and the original python function on separate buffers
+    compiled_qualified = batch_kernel.allocate_qualified_buffer(len(applicants), len(bank_data))
+    python_qualified = batch_kernel.allocate_qualified_buffer(len(applicants), len(bank_data))
+    batch_kernel._qualify_kernel(*applicant_arrays, *bank_arrays, compiled_qualified)
+    batch_kernel._qualify_kernel.py_func(*applicant_arrays, *bank_arrays, python_qualified)
+    assert compiled_qualified.tolist() == python_qualified.tolist()
+
+    # reusing a dirty buffer must give the same result
+    reused_qualified = batch_kernel.qualify_applicants(bank_arrays, applicants, ~compiled_qualified)
+    assert reused_qualified.tolist() == python_qualified.tolist()
+
+    # the compiled results should match the filters applicant by applicant
+    for applicant, row in zip(applicants, compiled_qualified):
+        assert int(row.sum()) == len(find_qualifying_loans_with_filters(bank_data, *applicant))
+
+class ScriptedQuestion:
+    """Stands in for a questionary question and answers with the next scripted answer"""
+    def __init__(self, answers):
+        self.answers = answers
+
+    def ask(self):
+        return self.answers.pop(0)
+
+def script_questionary(monkeypatch, app, answers):
+    """Makes every questionary prompt of the app return the next answer from the list
+
+    Input:
+        monkeypatch - the pytest monkeypatch fixture
+        app - the imported app module
+        answers - the answers in the order the prompts are asked
+    """
+    def question(*args, **kwargs):
+        return ScriptedQuestion(answers)
+    monkeypatch.setattr(app.questionary, "text", question)
+    monkeypatch.setattr(app.questionary, "confirm", question)
+    monkeypatch.setattr(app.questionary, "select", question)
+
+def test_run_session_survives_bad_applicant(monkeypatch, capsys):
+    """Validate that an applicant with an income of 0 or a cancelled (Ctrl+C) entry is skipped
+        and the session goes on to qualify the next applicant against the same rate sheet
+    """
+    pytest.importorskip("fire")
+    pytest.importorskip("questionary")
+    import app
+
+    script_questionary(monkeypatch, app, [
+        './data/daily_rate_sheet.csv',
+        "Qualify an applicant", '750', '1500', '0', '210000', '250000',
+        "Qualify an applicant", '750', None,
+        "Qualify an applicant", '750', '1500', '4000', '210000', '250000', False,
+        "Exit",
+    ])
+    app.run_session()
+    output = capsys.readouterr().out
+    assert "ZeroDivisionError" in output
+    assert "Applicant entry cancelled" in output
+    # the helpers' exit message is not shown since the session carries on
+    assert "Exiting" not in output
+    assert output.count("Skipping this applicant") == 2
+    assert "Found 6 qualifying loans" in output
+    assert "Session ended after 1 applicants" in output
+
+def test_run_session_keeps_rate_sheet_after_failed_reload(monkeypatch, capsys, tmp_path):
+    """Validate that reloading an empty rate sheet or one with a short row keeps the previously
+        loaded rate sheet and the next applicant is still qualified against it
+    """
+    pytest.importorskip("fire")
+    pytest.importorskip("questionary")
+    import app
+
+    empty_csvpath = tmp_path / "empty.csv"
+    empty_csvpath.write_text("")
+    short_row_csvpath = tmp_path / "short_row.csv"
+    short_row_csvpath.write_text("Lender,Max Loan Amount,Max LTV,Max DTI,Min Credit Score,Interest Rate\nA,300000,0.85\n")
+    script_questionary(monkeypatch, app, [
+        './data/daily_rate_sheet.csv',
+        "Reload the rate sheet", str(empty_csvpath),
+        "Reload the rate sheet", str(short_row_csvpath),
+        "Qualify an applicant", '750', '1500', '4000', '210000', '250000', False,
+        "Exit",
+    ])
+    app.run_session()
+    output = capsys.readouterr().out
+    assert "StopIteration" in output
+    assert "row 1 of the rate sheet has 3 columns instead of 6" in output
+    assert output.count("Keeping the previously loaded rate sheet") == 2
+    assert "Found 6 qualifying loans" in output
+    assert "Session ended after 1 applicants" in output
+
+def test_run_session_verbose_shows_filter_counts(monkeypatch, capsys):
+    """Validate that in verbose mode the session still shows the count after each filter
+    """
+    pytest.importorskip("fire")
+    pytest.importorskip("questionary")
+    import app
+
+    monkeypatch.setattr(app, "debug", True)
+    script_questionary(monkeypatch, app, [
+        './data/daily_rate_sheet.csv',
+        "Qualify an applicant", '750', '1500', '4000', '210000', '250000', False,
+        "Exit",
+    ])
+    app.run_session()
+    output = capsys.readouterr().out
+    # the same counts as test_filters
+    assert "Found 18 qualifying loans based on max loan size filter" in output
+    assert "Found 9 qualifying loans based on credit score filter" in output
+    assert "Found 8 qualifying loans based on debt to income filter" in output
+    assert "Found 6 qualifying loans based on loan to value filter" in output
+
+def test_profiler(tmp_path):
+    """Validate that the profiler saves the pstats dump and summary, times the phases and
+        leaves the time spent waiting for input out of the phase times
+    """
+    # load the header and bank loan data from the csv file
+    header, bank_data = fileio.load_csv(Path('./data/daily_rate_sheet.csv'))
+
+    profile_path = tmp_path / "loan_qualifier.prof"
+    with profiler.Profiler(str(profile_path)) as active_profiler:
+        with profiler.phase("count_qualifying_loans"):
+            # simulate a user taking 0.2 seconds to answer a prompt
+            with profiler.waiting_for_input():
+                time.sleep(0.2)
+            aggregators.count_qualifying_loans(bank_data, build_threshold_applicants())
+
+    # the profiler is no longer active once the block is done
+    assert profiler.active_profiler is None
+    # the phase was timed but the time waiting for input was left out
+    assert 0 < active_profiler.phase_times["count_qualifying_loans"] < 0.2
+    # ensure that the pstats dump and the text summary were created
+    assert profile_path.exists() == True
+    summary = (tmp_path / "loan_qualifier.txt").read_text()
+    # the hot spots list the application functions but not the profiler's own frames
+    assert "aggregators.py" in summary
+    assert "contextlib.py" not in summary
+    assert "profiler.py" not in summary
+
+def test_run_with_profile(monkeypatch, capsys, tmp_path):
+    """Validate that app.run(profile=<path>) times every phase of a scripted run and that
+        the time spent at the prompts is left out of the phase times
+    """
+    pytest.importorskip("fire")
+    pytest.importorskip("questionary")
+    import app
+
+    # every prompt takes 0.1 seconds to be answered
+    answers = [
+        './data/daily_rate_sheet.csv',
+        '750', '1500', '4000', '210000', '250000',
+        True, str(tmp_path / "qualifying_loans.csv"),
+    ]
+    def slow_question(*args, **kwargs):
+        time.sleep(0.1)
+        return ScriptedQuestion(answers)
+    monkeypatch.setattr(app.questionary, "text", slow_question)
+    monkeypatch.setattr(app.questionary, "confirm", slow_question)
+
+    profile_path = tmp_path / "run.prof"
+    app.run(profile=str(profile_path))
+    assert profile_path.exists() == True
+    summary = (tmp_path / "run.txt").read_text()
+
+    # read the phase times (in ms) from the summary
+    phase_times = {}
+    for line in summary.splitlines():
+        if line.endswith(" ms"):
+            name, milliseconds = line[:-3].rsplit(None, 1)
+            phase_times[name.strip()] = float(milliseconds)
+    assert set(phase_times) == {
+        "load_bank_data", "applicant input", "find_qualifying_loans", "save_qualifying_loans",
+        "filter_max_loan_size", "filter_credit_score", "filter_debt_to_income", "filter_loan_to_value",
+    }
+    # each phase waited at least 100 ms at its prompts, none of which may be counted
+    for name, milliseconds in phase_times.items():
+        assert milliseconds < 100
+    # the 8 prompts were reported as excluded waiting time
+    waiting_line = [line for line in summary.splitlines() if line.startswith("Time waiting for input")][0]
+    assert float(waiting_line.split(":")[1].split()[0]) >= 0.8
+    # the pstats hot spot rows point at the application functions
+    hot_spot_rows = [line for line in summary.splitlines() if "(" in line and line.strip()[:1].isdigit()]
+    assert any("app.py" in line and "(find_qualifying_loans)" in line for line in hot_spot_rows)
+    assert any("credit_score.py" in line and "(filter_credit_score)" in line for line in hot_spot_rows)
+    assert "contextlib.py" not in summary